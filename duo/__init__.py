@@ -2,26 +2,97 @@
 Sparse abstraction for working with the duo client api
 """
 
+import http.client
+import itertools
 import logging
 import sys
+import time
 from datetime import datetime
 from enum import Enum, auto
-from typing import Any, Callable, Dict, Iterable, List
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Collection,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+)
 
-import duo_client  # type:ignore
+from duo.cache import UserCache
+
+if TYPE_CHECKING:
+    from duo.admin import KeepAliveAdmin
 
 logger = logging.getLogger(__name__)
 PHONE_TIMESTAMP_KEY = "name"
+# Most usernames Duo will look up in one request
+USERNAME_LIST_LIMIT = 100
+# Platform of phones left in limbo by an abandoned registration, casefolded
+GENERIC_SMARTPHONE = "generic smartphone"
+# How users from the cache rather than Duo are described when logging them
+CACHE_SOURCE = "loaded from the cached user list"
 
 # pylint: disable=too-few-public-methods
 
 
+def _log_users(users: Iterable[dict], source: str) -> Iterator[dict]:
+    """
+    Pass through `users`, logging each as it is read, and how they were read,
+    e.g. "fetched from Duo"
+    """
+    count = 0
+    # Checked once rather than for each of what may be many thousands of users
+    debug = logger.isEnabledFor(logging.DEBUG)
+    for count, user in enumerate(users, start=1):
+        if debug:
+            logger.debug("User %s: `%s`", source, user["username"])
+        yield user
+    logger.info("%d users %s", count, source)
+
+
+def _cached_user(user: dict) -> dict:
+    """
+    Only the parts of a user from Duo which we work with, to save to the cache
+
+    Duo's users carry plenty more personal details (emails, real names, phone
+    numbers...) which have no business being kept on disk
+    """
+    return {
+        "username": user["username"],
+        "user_id": user["user_id"],
+        "phones": [
+            {
+                key: phone.get(key)
+                for key in ("phone_id", "platform", PHONE_TIMESTAMP_KEY)
+            }
+            for phone in user["phones"]
+        ],
+    }
+
+
 class ProcessPhoneResult(Enum):
     """Results from duo phone update"""
 
     TIMESTAMPED = auto()
     REMOVED = auto()
     NO_ACTION = auto()
+    FAILED = auto()
+
+
+class Phone(NamedTuple):
+    """
+    The parts of a phone from Duo which we work with, plus the user it is
+    registered to
+    """
+
+    phone_id: str
+    platform: str
+    # Value of the `PHONE_TIMESTAMP_KEY` field, "" if unset
+    timestamp: str
+    username: str
+    user_id: str
 
 
 class Duo:
@@ -30,100 +101,317 @@ class Duo:
 
     Choosing to leave this quite sparse due to our very simple use case
 
-    Puts the users in `self.users` and puts the phones into `self.phones`.
-    The phones are as they come from Duo, except with the `username` and
-    `user_id` added in so they can be operated upon on their own in this
-    program's context.
+    Streams the users from Duo (only those in `usernames`, if given), putting
+    their phones into `self.phones`. Each is a `Phone`, carrying the `username`
+    and `user_id` of its user so they can be operated upon on their own in this
+    program's context. Those which are "Generic Smartphone"s are also listed in
+    `self.generic_smartphones`.
+
+    Requests to Duo are made at most `rate_limit` times per second, if given.
+
+    If given a `cache`, it is used instead of fetching the users from Duo for as
+    long as it is fresh. Otherwise the users fetched are saved to it, and it is
+    fallen back upon if they cannot be fetched, unless it is older than its
+    `max_age`. Either way, phones from the cache are looked up in Duo again
+    before being removed.
 
     Use
     """
 
-    def __init__(self, *, ikey, skey, host):
-        logging.debug("Connecting to Duo API at host %s", host)
-        self.api: duo_client.Admin = duo_client.Admin(ikey=ikey, skey=skey, host=host)
-        logging.info("Fetching user list from Duo API")
+    def __init__(
+        self,
+        *,
+        ikey,
+        skey,
+        host,
+        usernames: Collection[str] = (),
+        cache: Optional[UserCache] = None,
+        rate_limit: float = 0,
+    ):
+        # `duo_client` pulls in a lot at import time, so only import it once it
+        # is actually needed rather than e.g. for `--help`
+        from duo.admin import (  # pylint: disable=import-outside-toplevel
+            KeepAliveAdmin,
+        )
+
+        logger.debug("Connecting to Duo API at host %s", host)
+        self.api: "KeepAliveAdmin" = KeepAliveAdmin(
+            ikey=ikey, skey=skey, host=host, rate_limit=rate_limit
+        )
+        if usernames and cache:
+            # The cache only ever holds the whole directory
+            logger.debug("Not using the user cache as specific users were given")
+            cache = None
+        # Whether the phones came from the cached user list rather than Duo
+        self.from_cache: bool = False
+        self.phones: List[Phone] = self._load_phones(
+            cache, cache.load() if cache else None, usernames
+        )
+        self.generic_smartphones: List[Phone] = [
+            phone
+            for phone in self.phones
+            if phone.platform.casefold() == GENERIC_SMARTPHONE
+        ]
+
+    def _load_phones(
+        self,
+        cache: Optional[UserCache],
+        cached: Optional[dict],
+        usernames: Collection[str],
+    ) -> List[Phone]:
+        """
+        Get the phones of the users, from the `cached` copy while it is fresh
+
+        Otherwise fetch them from Duo, saving the users to `cache`, and fall back
+        to the `cached` copy if they cannot be fetched
+        """
+        if cached is not None and time.time() < cached["stale_at"]:
+            logger.info(
+                "Using the cached user list from %s instead of fetching it from Duo",
+                datetime.fromtimestamp(cached["generated_at"]),
+            )
+            self.from_cache = True
+            return self._flatten_phones(cached["users"], source=CACHE_SOURCE)
+        logger.info("Fetching user list from Duo API")
         try:
-            self.users: Iterable = self.api.get_users()
+            users: Iterable[dict] = self._fetch_users(usernames)
+            if cache:
+                # The cache needs the whole list at once anyway
+                users = [_cached_user(user) for user in users]
+                cache.store(users)
+            return self._flatten_phones(users, source="fetched from Duo")
         except Exception:  # pylint: disable=broad-except
             # The Duo module barely handles its own exceptions so we have
             # little choice here
-            logging.error(
+            if cached is None or cache is None:
+                logger.error(
+                    (
+                        "Unknown problem fetching users from Duo. It may not have "
+                        "been able to connect, or the credentials may be "
+                        "incorrect. "
+                    ),
+                )
+                sys.exit(1)
+            if time.time() > cached["generated_at"] + cache.max_age:
+                logger.error(
+                    (
+                        "Unknown problem fetching users from Duo, and the cached "
+                        "user list from %s is too old to fall back on"
+                    ),
+                    datetime.fromtimestamp(cached["generated_at"]),
+                )
+                sys.exit(1)
+            logger.warning(
                 (
-                    "Unknown problem fetching users from Duo. It may not have "
-                    "been able to connect, or the credentials may be incorrect. "
+                    "Unknown problem fetching users from Duo. Falling back to the "
+                    "cached user list from %s (stale since %s)"
                 ),
+                datetime.fromtimestamp(cached["generated_at"]),
+                datetime.fromtimestamp(cached["stale_at"]),
             )
-            sys.exit(1)
-        logging.info("%d users fetched from Duo", len(self.users))  # type:ignore
-        logging.debug(
-            "users fetched from Duo: `%s`", [u["username"] for u in self.users]
+            self.from_cache = True
+            return self._flatten_phones(cached["users"], source=CACHE_SOURCE)
+
+    def _fetch_users(self, usernames: Collection[str]) -> Iterable[dict]:
+        """
+        Stream the users from Duo
+
+        Only the users in `usernames` if there are any, which Duo looks up for
+        us, rather than paging through the whole directory
+        """
+        if not usernames:
+            return self.api.get_users_iterator()
+        names = sorted(usernames)
+        logger.debug("Fetching only the users `%s`", names)
+        return itertools.chain.from_iterable(
+            self.api.get_users_by_names(names[start : start + USERNAME_LIST_LIMIT])
+            for start in range(0, len(names), USERNAME_LIST_LIMIT)
         )
-        self.phones: List[dict] = []
-        for user in self.users:
-            updates = {"username": user["username"], "user_id": user["user_id"]}
-            user_phones: List[dict] = user["phones"]
-            for phone in user_phones:
-                phone.update(updates)
-                self.phones.append(phone)
 
-    def process_phone(
-        self,
-        pre_test: Callable = lambda x: True,
+    @staticmethod
+    def _flatten_phones(users: Iterable[dict], source: str) -> List[Phone]:
+        """
+        Pick out the phones of all `users`, as they are read from `source` (see
+        `_log_users`)
+        """
+        return [
+            Phone(
+                phone_id=phone["phone_id"],
+                # Either may be missing or null, e.g. for a phone whose
+                # registration never got far enough to report its platform
+                platform=phone.get("platform") or "",
+                timestamp=phone.get(PHONE_TIMESTAMP_KEY) or "",
+                username=user["username"],
+                user_id=user["user_id"],
+            )
+            for user in _log_users(users, source)
+            for phone in user["phones"]
+        ]
+
+    @staticmethod
+    def plan_phone(
         *,
-        phone: Dict[str, Any],
-        time_cutoff: datetime,
+        phone: Phone,
+        time_cutoff: int,
     ) -> ProcessPhoneResult:
         """
-        Remove a phone if its timestamp is old enough, else create the timestamp
+        Decide what to do with a phone, without making any calls to Duo
 
-        Optionally will call specified `pre_test(`prompt`) before making any actual
-        writes or deletes, and skip the operation if it returns falsey
+        A "Generic Smartphone" should be removed if its timestamp is older than
+        `time_cutoff` (Unix time), and timestamped if it does not have one yet.
+        Any other phone is always left alone
         """
-        created_time = datetime.fromtimestamp(int(phone[PHONE_TIMESTAMP_KEY] or 0))
-        logging.debug(
+        if phone.platform.casefold() != GENERIC_SMARTPHONE:
+            # Callers normally only pass `generic_smartphones`, but never touch
+            # a fully registered phone regardless
+            return ProcessPhoneResult.NO_ACTION
+        # Our timestamps are whole seconds of Unix time. Anything else in the
+        # field is treated as there being no timestamp yet. Not `isdigit()`,
+        # which also accepts e.g. "²" which `int()` does not
+        created_ts = int(phone.timestamp) if phone.timestamp.isdecimal() else 0
+        logger.debug(
             "Processing phone for user `%s` with id `%s`, with timestamp value `%s`",
-            phone["username"],
-            phone["phone_id"],
-            phone[PHONE_TIMESTAMP_KEY],
+            phone.username,
+            phone.phone_id,
+            phone.timestamp,
         )
-        if not created_time.timestamp() and pre_test(
-            f'Write timestamp to `name` field for {phone["username"]}\'s phone '
-            f'`{phone["phone_id"]}`?'
-        ):
+        if not created_ts:
             # If there is no existing Unix time value in our metadata field,
             # place one
-            logging.info(
-                (
-                    "Updating new phone for the user `%s` with id "
-                    "`%s` with timestamp, to mark for cleanup on the "
-                    "next run"
-                ),
-                phone["username"],
-                phone["phone_id"],
-            )
-            self.api.update_phone(
-                phone_id=phone["phone_id"],
-                name=str(round(datetime.timestamp(datetime.utcnow()))),
-            )
             return ProcessPhoneResult.TIMESTAMPED
-        if created_time < time_cutoff and pre_test(
-            f'Remove {phone["username"]}\'s phone `{phone["phone_id"]}`?'
-        ):
+        if created_ts < time_cutoff:
             # Else if the phone was timestamped with a value before our grace
             # period, delete
-            logging.info(
-                "Deleting phone for the user `%s` with id `%s`",
-                phone["username"],
-                phone["phone_id"],
-            )
-            self.api.delete_phone(phone["phone_id"])
             return ProcessPhoneResult.REMOVED
-        logging.debug(
-            ("Taking no action on phone for the user `%s` with id `%s`"),
-            phone["username"],
-            phone["phone_id"],
-        )
         return ProcessPhoneResult.NO_ACTION
 
+    def _recheck_phone(
+        self,
+        *,
+        phone: Phone,
+        time_cutoff: int,
+    ) -> ProcessPhoneResult:
+        """
+        Decide what to do with a phone again, as it is in Duo right now
+
+        A phone from the cached user list may have changed since, most
+        importantly by its user finishing registering it
+        """
+        try:
+            current: dict = self.api.get_phone_by_id(phone.phone_id)
+        except RuntimeError as err:
+            if getattr(err, "status", None) != 404:
+                raise
+            logger.info(
+                "Phone for the user `%s` with id `%s` no longer exists in Duo",
+                phone.username,
+                phone.phone_id,
+            )
+            return ProcessPhoneResult.NO_ACTION
+        action = self.plan_phone(
+            phone=phone._replace(
+                platform=current.get("platform") or "",
+                timestamp=current.get(PHONE_TIMESTAMP_KEY) or "",
+            ),
+            time_cutoff=time_cutoff,
+        )
+        if action is not ProcessPhoneResult.REMOVED:
+            logger.info(
+                (
+                    "Phone for the user `%s` with id `%s` has changed in Duo since "
+                    "the cached user list, so is no longer to be removed"
+                ),
+                phone.username,
+                phone.phone_id,
+            )
+        return action
+
+    def apply_phone(
+        self,
+        action: ProcessPhoneResult,
+        *,
+        phone: Phone,
+        time_cutoff: int,
+        now_ts: Optional[int] = None,
+    ) -> ProcessPhoneResult:
+        """
+        Carry out an `action` decided upon by `plan_phone`, returning what was
+        done, or `FAILED` if Duo would not carry it out
+
+        If the phones came from the cache, a phone to be removed is first looked
+        up in Duo again and only removed if it still should be as of
+        `time_cutoff`. New timestamps are `now_ts` (Unix time), which callers
+        processing many phones can compute once up front. Defaults to the
+        current time
+        """
+        try:
+            if action is ProcessPhoneResult.REMOVED and self.from_cache:
+                action = self._recheck_phone(phone=phone, time_cutoff=time_cutoff)
+            if action is ProcessPhoneResult.TIMESTAMPED:
+                logger.info(
+                    (
+                        "Updating new phone for the user `%s` with id "
+                        "`%s` with timestamp, to mark for cleanup on the "
+                        "next run"
+                    ),
+                    phone.username,
+                    phone.phone_id,
+                )
+                self.api.update_phone(
+                    phone_id=phone.phone_id,
+                    name=str(int(time.time()) if now_ts is None else now_ts),
+                )
+            elif action is ProcessPhoneResult.REMOVED:
+                logger.info(
+                    "Deleting phone for the user `%s` with id `%s`",
+                    phone.username,
+                    phone.phone_id,
+                )
+                self.api.delete_phone(phone.phone_id)
+            # Phones left alone are only counted, by the caller, as there may be
+            # thousands of them
+        except (http.client.HTTPException, OSError, RuntimeError) as err:
+            # Duo has already retried any rate limited requests by now. Whatever
+            # this was, it only concerns this phone, so carry on with the rest
+            logger.error(
+                "Failed to act on phone for the user `%s` with id `%s`: %s",
+                phone.username,
+                phone.phone_id,
+                err,
+            )
+            return ProcessPhoneResult.FAILED
+        return action
+
+    def process_phone(
+        self,
+        pre_test: Optional[Callable] = None,
+        *,
+        phone: Phone,
+        time_cutoff: int,
+        now_ts: Optional[int] = None,
+    ) -> ProcessPhoneResult:
+        """
+        Remove a phone if its timestamp is old enough, else create the timestamp
+
+        Optionally will call specified `pre_test(`prompt`) before making any actual
+        writes or deletes, and skip the operation if it returns falsey
+
+        See `plan_phone` and `apply_phone`, which this combines
+        """
+        action = self.plan_phone(phone=phone, time_cutoff=time_cutoff)
+        if pre_test is not None and action is not ProcessPhoneResult.NO_ACTION:
+            if action is ProcessPhoneResult.TIMESTAMPED:
+                prompt = (
+                    f"Write timestamp to `name` field for {phone.username}'s phone "
+                    f"`{phone.phone_id}`?"
+                )
+            else:
+                prompt = f"Remove {phone.username}'s phone `{phone.phone_id}`?"
+            if not pre_test(prompt):
+                action = ProcessPhoneResult.NO_ACTION
+        return self.apply_phone(
+            action, phone=phone, time_cutoff=time_cutoff, now_ts=now_ts
+        )
+
 
 # pylint: enable=too-few-public-methods
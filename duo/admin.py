@@ -0,0 +1,101 @@
+"""
+Duo Admin API client tuned for making many requests
+
+Reuses its HTTPS connections, can limit its request rate, and parses responses
+with `orjson` if installed
+"""
+
+import json
+import threading
+import time
+import types
+
+import duo_client  # type:ignore
+import duo_client.client  # type:ignore
+
+try:
+    import orjson  # type:ignore
+except ImportError:
+    pass
+else:
+    # Parsing responses (notably the pages of users and their phones) is a large
+    # share of the client's own work, and `orjson` does it several times faster.
+    # Only `loads` is swapped: `orjson.dumps` cannot produce the canonical JSON
+    # used when signing requests. The stdlib module is left untouched for
+    # everyone else
+    duo_client.client.json = types.SimpleNamespace(
+        **{**vars(json), "loads": orjson.loads}  # pylint: disable=no-member
+    )
+
+
+class RateLimiter:  # pylint: disable=too-few-public-methods
+    """Spaces out calls to `wait` to at most `rate` per second, across threads"""
+
+    def __init__(self, rate: float):
+        self.interval: float = 1 / rate
+        self._lock = threading.Lock()
+        self._next: float = time.monotonic()
+
+    def wait(self) -> None:
+        """Block until the next call is allowed"""
+        with self._lock:
+            now = time.monotonic()
+            allowed_at = max(now, self._next)
+            self._next = allowed_at + self.interval
+        time.sleep(allowed_at - now)
+
+
+class KeepAliveAdmin(duo_client.Admin):  # pylint: disable=too-many-ancestors
+    """
+    `duo_client.Admin`, but keeping one connection open per thread
+
+    The stock client opens a new connection for every request and closes it
+    again afterwards, paying for a fresh TCP and TLS handshake on each API call.
+    Here the connection is kept open and reused by the next request made from
+    the same thread. Threads never share a connection, so this is safe to use
+    from a thread pool.
+
+    If given a `rate_limit`, requests (including retries) are made at most that
+    many times per second, however many threads are making them.
+    """
+
+    def __init__(self, *args, rate_limit: float = 0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._local = threading.local()
+        self._rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = super()._connect()
+            self._local.conn = conn
+        return conn
+
+    def _disconnect(self, conn):
+        # Leave the connection open for the next request on this thread
+        pass
+
+    def _attempt_single_request(
+        self, conn, method, uri, body, headers
+    ):  # pylint: disable=too-many-arguments
+        try:
+            return self._attempt_once(conn, method, uri, body, headers)
+        except ConnectionError:
+            # The server may have dropped our idle connection in the meantime,
+            # and a new one is opened for the next request, so try once more
+            return self._attempt_once(conn, method, uri, body, headers)
+
+    def _attempt_once(
+        self, conn, method, uri, body, headers
+    ):  # pylint: disable=too-many-arguments
+        # Every attempt counts towards the rate limit, retries included
+        if self._rate_limiter:
+            self._rate_limiter.wait()
+        try:
+            return super()._attempt_single_request(conn, method, uri, body, headers)
+        except BaseException:
+            # Whatever went wrong (e.g. a malformed response or a timeout), the
+            # connection may be left midway through a request, refusing to send
+            # any more. Closing it makes the next request open a new one
+            conn.close()
+            raise
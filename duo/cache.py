@@ -0,0 +1,120 @@
+"""
+On-disk copy of the user list fetched from Duo
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import zlib
+from pathlib import Path
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+DEFAULT_CACHE_DIR = (
+    Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "duo_phone_cleanup"
+)
+# Oldest a cached copy may be to still fall back on, in seconds
+DEFAULT_CACHE_MAX_AGE = 24 * 60 * 60
+
+# pylint: disable=too-few-public-methods
+
+
+class UserCache:
+    """
+    Gzipped JSON copy of the users (and their phones) as last fetched from a Duo
+    `host` with integration key `ikey`
+
+    Alongside the users it records when they were fetched (`generated_at`) and
+    when the copy should be considered stale (`stale_at`), both in Unix time.
+    Once older than `max_age` seconds, it is not to be fallen back on either.
+    The users contain personal details, so the file is only readable by its
+    owner.
+    """
+
+    FILENAME = "users-{key}.json.gz"
+
+    def __init__(
+        self,
+        *,
+        directory: Path,
+        ttl: int,
+        host: str,
+        ikey: str,
+        max_age: int = DEFAULT_CACHE_MAX_AGE,
+    ):
+        # One copy per Duo account and integration, so that e.g. a run against
+        # another account never picks up this one's users
+        key = hashlib.sha256(f"{host}\0{ikey}".encode("utf-8")).hexdigest()[:16]
+        self.path: Path = Path(directory) / self.FILENAME.format(key=key)
+        self.ttl: int = ttl
+        self.max_age: int = max_age
+
+    def load(self) -> Optional[dict]:
+        """Return the cached entry, or None if there is no usable one"""
+        try:
+            entry: dict = json.loads(gzip.decompress(self.path.read_bytes()))
+            generated_at = entry["generated_at"]
+            if not (
+                isinstance(generated_at, (int, float))
+                and isinstance(entry["stale_at"], (int, float))
+                and isinstance(entry["users"], list)
+            ):
+                raise TypeError("Unexpected types in user cache")
+        except FileNotFoundError:
+            logger.debug("No user cache found at `%s`", self.path)
+            return None
+        except (EOFError, KeyError, OSError, TypeError, ValueError, zlib.error):
+            logger.warning("Ignoring unreadable user cache `%s`", self.path)
+            return None
+        logger.debug(
+            "Loaded user cache `%s` generated at `%s`", self.path, generated_at
+        )
+        return entry
+
+    def store(self, users: List[dict]) -> None:
+        """
+        Save the users, replacing any previous copy
+
+        Failing to write the cache is logged but otherwise not an error
+        """
+        now = int(time.time())
+        self._write({"generated_at": now, "stale_at": now + self.ttl, "users": users})
+
+    def expire(self) -> None:
+        """
+        Mark the cached copy as stale, e.g. once Duo has been changed since
+
+        It is kept to fall back on if Duo cannot be reached
+        """
+        entry = self.load()
+        if entry is not None and entry["stale_at"] > entry["generated_at"]:
+            self._write({**entry, "stale_at": entry["generated_at"]})
+
+    def _write(self, entry: dict) -> None:
+        try:
+            self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            # Write to a temporary file first so that a reader never sees a
+            # partially written cache
+            handle, tmp_path = tempfile.mkstemp(
+                dir=self.path.parent, prefix=f".{self.path.name}."
+            )
+            try:
+                with os.fdopen(handle, mode="wb") as cachefile:
+                    cachefile.write(gzip.compress(json.dumps(entry).encode("utf-8")))
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as err:
+            logger.warning("Could not write user cache `%s`: %s", self.path, err)
+            return
+        logger.debug(
+            "Wrote user cache `%s`, stale at `%s`", self.path, entry["stale_at"]
+        )
+
+
+# pylint: enable=too-few-public-methods
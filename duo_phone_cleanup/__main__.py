@@ -5,47 +5,61 @@ Cleanup Duo accounts.
 
 import argparse
 import logging
+import math
 import os
 import sys
-from collections import defaultdict
-from datetime import datetime, timedelta
-from typing import Any, Dict
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Dict, List, Optional
 
 
 # Duo phones in the API have no hidden metadata fields or anything, so we're
 # using the `name` field which starts out empty. This could change if we
 # discover some field more appropriate for our metadata in the future
-from duo import PHONE_TIMESTAMP_KEY, Duo, ProcessPhoneResult
+from duo import PHONE_TIMESTAMP_KEY, Duo, Phone, ProcessPhoneResult
+from duo.cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_MAX_AGE, UserCache
 
+# Accepted answers to a confirmation prompt, by what they mean: "y" to approve
+# the action, "n" to skip it, or "a" to approve it and all remaining actions.
+# The values for "y" and "n" are those of the old `distutils.util.strtobool`
+PROMPT_ANSWERS: Dict[str, str] = {
+    **dict.fromkeys(("y", "yes", "t", "true", "on", "1"), "y"),
+    **dict.fromkeys(("n", "no", "f", "false", "off", "0"), "n"),
+    **dict.fromkeys(("a", "all"), "a"),
+}
+# Should be `BooleanOptionalAction` if Python >= 3.9, else the old way
+BOOL_ACTION: Any = getattr(argparse, "BooleanOptionalAction", "store_true")
 
-def strtobool(val):
-    """
-    Stolen from deprecated `distutils.util.strtobool`
 
-    Convert a string representation of truth to true (1) or false (0).
-    True values are 'y', 'yes', 't', 'true', 'on', and '1'; false values
-    are 'n', 'no', 'f', 'false', 'off', and '0'.  Raises ValueError if
-    'val' is anything else.
-    """
-    val = val.lower()
-    if val in ("y", "yes", "t", "true", "on", "1"):
-        return 1
-    if val in ("n", "no", "f", "false", "off", "0"):
-        return 0
+def positive_int(value: str) -> int:
+    """`argparse` type for a whole number greater than 0"""
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be greater than 0, not {number}")
+    return number
+
+
+def non_negative_int(value: str) -> int:
+    """`argparse` type for a whole number which is 0 or more"""
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must be 0 or more, not {number}")
+    return number
+
 
-    raise ValueError(f"invalid truth value {val}")
+def non_negative_float(value: str) -> float:
+    """`argparse` type for a number which is 0 or more"""
+    number = float(value)
+    if number < 0 or math.isnan(number):
+        raise argparse.ArgumentTypeError(f"must be 0 or more, not {number}")
+    return number
 
 
 def parse_args(argv=None) -> argparse.Namespace:
     """Parse args"""
 
-    bool_action = (
-        # Should be `BooleanOptionalAction` if Python >= 3.9, else the old way
-        argparse.BooleanOptionalAction
-        if hasattr(argparse, "BooleanOptionalAction")
-        else "store_true"
-    )
-
     usage_examples: str = """examples:
 
         %(prog)s <args>
@@ -115,7 +129,7 @@ def parse_args(argv=None) -> argparse.Namespace:
     parser.add_argument(
         "--force",
         "-f",
-        action=bool_action,  # type:ignore
+        action=BOOL_ACTION,  # type:ignore
         default=os.environ.get("DUO_FORCE", True),
         help=(
             "If negated with `--no-force`, this tool will prompt for confirmation "
@@ -124,6 +138,62 @@ def parse_args(argv=None) -> argparse.Namespace:
         type=bool,
     )
 
+    parser.add_argument(
+        "--workers",
+        "-w",
+        default=os.environ.get("DUO_WORKERS", 16),
+        help=(
+            "The maximum number of phones to process concurrently. Only applies "
+            "with `--force`, as confirmation prompts are always handled one at a "
+            "time"
+        ),
+        type=positive_int,
+    )
+
+    parser.add_argument(
+        "--rate-limit",
+        "-r",
+        default=os.environ.get("DUO_RATE_LIMIT", 0),
+        help=(
+            "The maximum number of requests per second to make to the Duo API, "
+            "across all workers. Unlimited if 0 (the default), relying on Duo's "
+            "own rate limiting responses"
+        ),
+        type=non_negative_float,
+    )
+
+    parser.add_argument(
+        "--cache-ttl",
+        "-c",
+        default=os.environ.get("DUO_CACHE_TTL", 0),
+        help=(
+            "Keep a copy of the user list fetched from Duo on disk, and use it "
+            "instead of fetching the users again for this many minutes, or until "
+            "this tool changes a phone. A stale copy is still fallen back on if "
+            "Duo cannot be reached. Phones from the copy are always looked up in "
+            "Duo again before being removed. Disabled if 0 (the default)"
+        ),
+        type=non_negative_int,
+    )
+
+    parser.add_argument(
+        "--cache-max-age",
+        default=os.environ.get("DUO_CACHE_MAX_AGE", DEFAULT_CACHE_MAX_AGE // 60),
+        help=(
+            "The oldest (in minutes) that the `--cache-ttl` copy of the user list "
+            "may be to still fall back on if Duo cannot be reached. Older than "
+            "that, the run fails instead"
+        ),
+        type=positive_int,
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        default=os.environ.get("DUO_CACHE_DIR", DEFAULT_CACHE_DIR),
+        help="Directory to keep the `--cache-ttl` copy of the user list in",
+        type=Path,
+    )
+
     parser.add_argument(
         "--verbose",
         "-v",
@@ -141,7 +211,10 @@ def parse_args(argv=None) -> argparse.Namespace:
         type=str,
     )
 
-    args = parser.parse_args(argv) if argv else parser.parse_args()
+    # `None` (not an empty list) means `sys.argv`
+    args = parser.parse_args(argv)
+    # Checked against every phone, so make lookups constant time
+    args.users = frozenset(args.users)
 
     if args.verbosity >= 2:
         log_level = logging.DEBUG
@@ -159,16 +232,30 @@ def parse_args(argv=None) -> argparse.Namespace:
     return args
 
 
-def user_verify(prompt: str) -> bool:
-    """Get user verifcation before an action"""
-    print(f"{prompt} [y/n]")
-    while True:
-        try:
-            inp = input().lower()
+class UserVerify:  # pylint: disable=too-few-public-methods
+    """
+    Get user verification before each action, until they choose to approve all
+    of the remaining actions at once
+    """
+
+    def __init__(self) -> None:
+        self.approve_all: bool = False
+
+    def __call__(self, prompt: str) -> bool:
+        if self.approve_all:
+            logging.debug("Prompt `%s` approved along with all others", prompt)
+            return True
+        print(f"{prompt} [y/n/a(ll)]")
+        while True:
+            inp = input().strip().lower()
             logging.debug("User input for prompt `%s`: `%s`", prompt, inp)
-            return strtobool(inp)
-        except ValueError:
-            print("Please respond with 'y' or 'n'")
+            answer = PROMPT_ANSWERS.get(inp)
+            if answer == "a":
+                self.approve_all = True
+                return True
+            if answer is not None:
+                return answer == "y"
+            print("Please respond with 'y', 'n', or 'a' to approve all")
 
 
 def main(
@@ -176,59 +263,110 @@ def main(
 ) -> None:
     """main"""
     args = parse_args(argv)
-    args_redacted: Dict[str, Any] = {
-        # Redact the secret key
-        k: f"{v[0]}{'*'*len(v)}{v[-1]}" if k == "skey" else v
-        for k, v in vars(args).items()
-    }
-    logging.debug("Argparse results: %s", args_redacted)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        args_redacted: Dict[str, Any] = {
+            # Redact the secret key
+            k: f"{v[0]}{'*'*len(v)}{v[-1]}" if k == "skey" and v else v
+            for k, v in vars(args).items()
+        }
+        logging.debug("Argparse results: %s", args_redacted)
     logging.info(
         "Will use the field `%s` to check/store timestamps for phones",
         PHONE_TIMESTAMP_KEY,
     )
+    cache: Optional[UserCache] = (
+        UserCache(
+            directory=args.cache_dir,
+            ttl=args.cache_ttl * 60,
+            max_age=args.cache_max_age * 60,
+            host=args.host,
+            ikey=args.ikey,
+        )
+        if args.cache_ttl
+        else None
+    )
     # Retrieve user info from API:
-    duo: Duo = Duo(ikey=args.ikey, skey=args.skey, host=args.host)
-    processed: defaultdict = defaultdict(int)
-    res: ProcessPhoneResult
-    # Operate on phones where appropriate
-    for phone in duo.phones:
-        if args.users and phone["username"] not in args.users:
-            # If we have specific users to operate upon and this is not one of
-            # them
-            logging.debug(
-                (
-                    "Skipping phone `%s` for user `%s` - not in the list of users to "
-                    "operate upon"
-                ),
-                phone["phone_id"],
-                phone["username"],
-            )
-            continue
-        if phone["platform"].lower() == "generic smartphone":
-            grace_period_time = datetime.utcnow() - timedelta(
-                minutes=int(args.grace_period)
-            )
-            if args.force:
-                res = duo.process_phone(phone=phone, time_cutoff=grace_period_time)
-                processed[res] += 1
-            else:
-                res = duo.process_phone(
-                    phone=phone, time_cutoff=grace_period_time, pre_test=user_verify
+    duo: Duo = Duo(
+        ikey=args.ikey,
+        skey=args.skey,
+        host=args.host,
+        usernames=args.users,
+        cache=cache,
+        rate_limit=args.rate_limit,
+    )
+    processed: Counter = Counter()
+    # Read the clock once for the whole run. Timestamps are Unix time
+    now_ts = int(time.time())
+    grace_period_time = now_ts - args.grace_period * 60
+    # Only "Generic Smartphone"s are ever acted upon
+    processed[ProcessPhoneResult.NO_ACTION] += len(duo.phones) - len(
+        duo.generic_smartphones
+    )
+    # Select the phones to operate upon. Duo only returns the users asked for
+    # anyway, but this keeps to them regardless of where the users came from
+    phones: List[Phone] = [
+        phone
+        for phone in duo.generic_smartphones
+        if not args.users or phone.username in args.users
+    ]
+    if len(phones) < len(duo.generic_smartphones):
+        logging.debug(
+            "Skipping %d phones of users not in the list of users to operate upon",
+            len(duo.generic_smartphones) - len(phones),
+        )
+    if args.force:
+        # Deciding what to do with a phone needs no calls to Duo, so do that
+        # up front. Carrying it out is mostly spent waiting on the Duo API,
+        # and each phone is independent, so do those concurrently
+        actions = [
+            (duo.plan_phone(phone=phone, time_cutoff=grace_period_time), phone)
+            for phone in phones
+        ]
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            futures = [
+                executor.submit(
+                    duo.apply_phone,
+                    action,
+                    phone=phone,
+                    time_cutoff=grace_period_time,
+                    now_ts=now_ts,
                 )
-            processed[res] += 1
-        else:
-            logging.debug(
-                "Phone `%s` for user `%s` not `Generic Smartphone`, taking no action",
-                phone["phone_id"],
-                phone["username"],
+                for action, phone in actions
+                if action is not ProcessPhoneResult.NO_ACTION
+            ]
+            processed[ProcessPhoneResult.NO_ACTION] += len(actions) - len(futures)
+            processed.update(future.result() for future in as_completed(futures))
+    else:
+        # Confirmation prompts have to be handled one at a time
+        user_verify = UserVerify()
+        processed.update(
+            duo.process_phone(
+                phone=phone,
+                time_cutoff=grace_period_time,
+                now_ts=now_ts,
+                pre_test=user_verify,
             )
-            processed[ProcessPhoneResult.NO_ACTION] += 1
+            for phone in phones
+        )
+    if cache and (
+        processed[ProcessPhoneResult.TIMESTAMPED]
+        or processed[ProcessPhoneResult.REMOVED]
+    ):
+        # The cached copy no longer matches Duo, e.g. it would show phones we
+        # just timestamped as not timestamped yet
+        cache.expire()
     logging.info(
-        "Processing complete. {timestamped: %s, removed: %s, no_action: %s",
+        "Processing complete. timestamped: %s, removed: %s, no_action: %s, "
+        "failed: %s",
         processed[ProcessPhoneResult.TIMESTAMPED],
         processed[ProcessPhoneResult.REMOVED],
         processed[ProcessPhoneResult.NO_ACTION],
+        processed[ProcessPhoneResult.FAILED],
     )
+    if processed[ProcessPhoneResult.FAILED]:
+        # Those phones are retried on the next run, but make the failures
+        # noticeable to whatever scheduled this one
+        sys.exit(1)
 
 
 if __name__ == "__main__":
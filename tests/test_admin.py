@@ -0,0 +1,159 @@
+"""
+Test the Duo Admin API client against a local HTTP server standing in for Duo
+
+Unlike in the end-to-end tests, nothing in `duo_client` is mocked, so this covers
+how connections are kept open and reopened, and how requests are rate limited
+"""
+
+import http.client
+import http.server
+import json
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Tuple
+
+import pytest  # type:ignore
+
+from duo.admin import KeepAliveAdmin, RateLimiter
+
+
+class MockDuoHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answer every request with an empty successful Duo response
+
+    Records the client address of each new connection in `server.connections`,
+    and closes the connection after answering for phones named "drop". For
+    phones named "garble", answers with a malformed status line instead
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self) -> None:
+        super().setup()
+        self.server.connections.append(self.client_address)  # type:ignore
+
+    def do_DELETE(self) -> None:  # pylint: disable=invalid-name
+        """Answer a request"""
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.path.startswith("/admin/v1/phones/garble"):
+            self.wfile.write(b"garbage\r\n")
+            return
+        body = json.dumps({"stat": "OK", "response": ""}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.path.startswith("/admin/v1/phones/drop"):
+            # pylint: disable-next=attribute-defined-outside-init
+            self.close_connection = True
+
+    def log_message(self, *args) -> None:  # pylint: disable=arguments-differ
+        pass
+
+
+@pytest.fixture(name="mock_duo_server")
+def fixture_mock_duo_server() -> Iterator[Tuple[int, List[tuple]]]:
+    """Serve on a free local port, giving the port and the connections made"""
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), MockDuoHandler)
+    server.daemon_threads = True
+    server.connections = []  # type:ignore
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    )
+    thread.start()
+    yield server.server_address[1], server.connections  # type:ignore
+    server.shutdown()
+    server.server_close()
+
+
+def make_admin(port: int, **kwargs) -> KeepAliveAdmin:
+    """A client for the local server, over plain HTTP"""
+    return KeepAliveAdmin(
+        ikey="DIXXXXXXXXXXXXXXXXXX",
+        skey="x" * 40,
+        host="127.0.0.1",
+        port=port,
+        ca_certs="HTTP",
+        **kwargs,
+    )
+
+
+def test_connection_reused(mock_duo_server):
+    """Test that consecutive requests from one thread share one connection"""
+    port, connections = mock_duo_server
+    admin = make_admin(port)
+
+    for number in range(5):
+        admin.delete_phone(f"phone_{number}")
+
+    assert len(connections) == 1, "Requests did not share a connection"
+
+
+def test_reconnect(mock_duo_server):
+    """Test that a request after the server closed the connection reconnects"""
+    port, connections = mock_duo_server
+    admin = make_admin(port)
+
+    admin.delete_phone("drop")
+    admin.delete_phone("phone_1")
+    admin.delete_phone("phone_2")
+
+    assert len(connections) == 2, "Closed connection was not replaced exactly once"
+
+
+def test_bad_response(mock_duo_server):
+    """Test that a request after a malformed response still succeeds"""
+    port, _ = mock_duo_server
+    admin = make_admin(port)
+
+    admin.delete_phone("phone_1")
+    with pytest.raises(http.client.BadStatusLine):
+        admin.delete_phone("garble")
+    admin.delete_phone("phone_2")
+    admin.delete_phone("phone_3")
+
+
+def test_rate_limiter_spacing():
+    """Test that calls from many threads are spaced out to the rate"""
+    limiter = RateLimiter(50)
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for _ in range(12):
+            executor.submit(limiter.wait)
+    elapsed = time.monotonic() - start
+
+    # The first call is allowed straight away
+    assert elapsed >= 11 / 50, "Calls were allowed faster than the rate"
+
+
+def test_rate_limit(mock_duo_server):
+    """Test that requests from many threads are made at most `rate_limit`/s"""
+    port, connections = mock_duo_server
+    admin = make_admin(port, rate_limit=50)
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(admin.delete_phone, [f"phone_{n}" for n in range(20)]))
+    elapsed = time.monotonic() - start
+
+    assert elapsed >= 19 / 50, "Requests were made faster than the rate limit"
+    assert len(connections) <= 4, "Threads did not each keep their connection"
+
+
+def test_rate_limit_retries(mock_duo_server):
+    """Test that retrying on a new connection also waits for the rate limit"""
+    port, connections = mock_duo_server
+    admin = make_admin(port, rate_limit=5)
+
+    start = time.monotonic()
+    admin.delete_phone("drop")
+    admin.delete_phone("phone_1")
+    elapsed = time.monotonic() - start
+
+    assert len(connections) == 2, "The request was not retried"
+    # The first request, then both attempts at the second
+    assert elapsed >= 2 / 5, "The retry was made faster than the rate limit"
@@ -5,8 +5,12 @@ mock the bits of the Duo API that get touched by our script and verify the resul
 """
 # pylint: disable=global-statement
 
+import gzip
+import http.client
 import json
-from typing import Any, List
+import logging
+import time
+from typing import Any, Iterator, List
 
 import duo_client  # type:ignore
 import pytest  # type:ignore
@@ -15,9 +19,13 @@ import duo_phone_cleanup.__main__ as program  # type:ignore
 
 
 MOCK_GET_USERS_CALLED_COUNT: int = 0
+MOCK_GET_USERS_BY_NAMES_CALLED: list = []
 MOCK_DELETE_PHONE_CALLED: list = []
 MOCK_UPDATE_PHONE_CALLED: list = []
 
+with open("tests/users.json", mode="r", encoding="utf-8") as userfile:
+    USERS: List[dict] = json.load(userfile)
+
 
 # pylint: disable=unused-argument
 # pylint: disable=global-variable-not-assigned
@@ -34,11 +42,33 @@ def mock_update_phone(_, *, phone_id: str, name: str) -> Any:
 
 
 def mock_get_users(_) -> List[dict]:
-    """Return the users as Python list"""
+    """
+    Return the users as Python list
+
+    Stands in for `get_users_iterator`, as any iterable of users will do
+    """
     global MOCK_GET_USERS_CALLED_COUNT
     MOCK_GET_USERS_CALLED_COUNT += 1
-    with open("tests/users.json", mode="r", encoding="utf-8") as userfile:
-        return json.load(userfile)
+    # Nothing modifies the users, so a copy of the list itself will do
+    return list(USERS)
+
+
+def mock_get_users_by_names(_, usernames: List[str]) -> List[dict]:
+    """Return the users with the given usernames as Python list"""
+    global MOCK_GET_USERS_BY_NAMES_CALLED
+    MOCK_GET_USERS_BY_NAMES_CALLED.append(list(usernames))
+    return [user for user in USERS if user["username"] in usernames]
+
+
+def mock_get_phone_by_id(_, phone_id: str) -> dict:
+    """Return the phone with the given id, as it is in the test users"""
+    for user in USERS:
+        for phone in user["phones"]:
+            if phone["phone_id"] == phone_id:
+                return dict(phone)
+    error = RuntimeError("Received 404 Resource not found")
+    error.status = 404  # type:ignore
+    raise error
 
 
 def mock_delete_phone(_, phone_id: str) -> Any:
@@ -57,22 +87,47 @@ def mock_delete_phone(_, phone_id: str) -> Any:
 # pylint enable=unused-argument
 
 
+@pytest.fixture(name="mock_duo")
+def fixture_mock_duo(monkeypatch) -> None:
+    """Mock the bits of the Duo API that get touched, and reset their records"""
+    global MOCK_GET_USERS_CALLED_COUNT
+    global MOCK_GET_USERS_BY_NAMES_CALLED
+    global MOCK_UPDATE_PHONE_CALLED
+    global MOCK_DELETE_PHONE_CALLED
+    MOCK_GET_USERS_CALLED_COUNT = 0
+    MOCK_GET_USERS_BY_NAMES_CALLED = []
+    MOCK_UPDATE_PHONE_CALLED = []
+    MOCK_DELETE_PHONE_CALLED = []
+    monkeypatch.setattr(duo_client.Admin, "get_users_iterator", mock_get_users)
+    monkeypatch.setattr(duo_client.Admin, "get_users_by_names", mock_get_users_by_names)
+    monkeypatch.setattr(duo_client.Admin, "get_phone_by_id", mock_get_phone_by_id)
+    monkeypatch.setattr(duo_client.Admin, "update_phone", mock_update_phone)
+    monkeypatch.setattr(duo_client.Admin, "delete_phone", mock_delete_phone)
+
+
 @pytest.mark.parametrize(
     "test_input,expected",
-    # The test users list includes three users so we can test different
+    # The test users list includes several users so we can test different
     # scenarios:
     #
     # * one user with a "Generic Smartphone" and no timestamp (`barret`)
     #   - Should generally only get stamped, not deleted
+    # * one user with a "Generic Smartphone" named something other than a
+    #   timestamp (`aerith`)
+    #   - Should be treated as having no timestamp, so stamped, not deleted
     # * one user with a "Generic Smartphone" and very old timestamp (`cloud`)
     #   - Should generally be deleted
     # * one more user with a "Generic Smartphone" and very old timestamp (`sephiroth`)
     #   - Should generally be deleted
-    # * one user with a fully registered iPhone (`redxxi`)
+    # * one user with a fully registered iPhone and a phone with no platform or
+    #   name at all (`redxiii`)
     #   - should never be touched
     # * one user with a "Generic Smartphone" and far future timestamp `(`tifa`)
     #   - Should not be deleted as the stamp is not older than the grace period
     #     (unless we're still running these tests in the year 4876)
+    # * one user with a "Generic Smartphone" named with a digit `int()` cannot
+    #   parse (`yuffie`)
+    #   - Should be treated as having no timestamp, so stamped, not deleted
     #
     # Now here are the sets of inputs and their matching results that we are
     # testing for
@@ -90,7 +145,12 @@ def mock_delete_phone(_, phone_id: str) -> Any:
             ],
             {
                 "MOCK_GET_USERS_CALLED_COUNT": 1,
-                "MOCK_UPDATE_PHONE_CALLED": [{"phone_id": "barret_phone_1"}],
+                "MOCK_GET_USERS_BY_NAMES_CALLED": [],
+                "MOCK_UPDATE_PHONE_CALLED": [
+                    {"phone_id": "aerith_phone_1"},
+                    {"phone_id": "barret_phone_1"},
+                    {"phone_id": "yuffie_phone_1"},
+                ],
                 "MOCK_DELETE_PHONE_CALLED": [
                     {"phone_id": "cloud_phone_1"},
                     {"phone_id": "sephiroth_phone_1"},
@@ -113,7 +173,12 @@ def mock_delete_phone(_, phone_id: str) -> Any:
             ],
             {
                 "MOCK_GET_USERS_CALLED_COUNT": 1,
-                "MOCK_UPDATE_PHONE_CALLED": [{"phone_id": "barret_phone_1"}],
+                "MOCK_GET_USERS_BY_NAMES_CALLED": [],
+                "MOCK_UPDATE_PHONE_CALLED": [
+                    {"phone_id": "aerith_phone_1"},
+                    {"phone_id": "barret_phone_1"},
+                    {"phone_id": "yuffie_phone_1"},
+                ],
                 "MOCK_DELETE_PHONE_CALLED": [
                     {"phone_id": "cloud_phone_1"},
                     {"phone_id": "sephiroth_phone_1"},
@@ -135,7 +200,8 @@ def mock_delete_phone(_, phone_id: str) -> Any:
                 "barret",
             ],
             {
-                "MOCK_GET_USERS_CALLED_COUNT": 1,
+                "MOCK_GET_USERS_CALLED_COUNT": 0,
+                "MOCK_GET_USERS_BY_NAMES_CALLED": [["barret"]],
                 "MOCK_UPDATE_PHONE_CALLED": [
                     {"phone_id": "barret_phone_1"},
                 ],
@@ -156,7 +222,8 @@ def mock_delete_phone(_, phone_id: str) -> Any:
                 "cloud",
             ],
             {
-                "MOCK_GET_USERS_CALLED_COUNT": 1,
+                "MOCK_GET_USERS_CALLED_COUNT": 0,
+                "MOCK_GET_USERS_BY_NAMES_CALLED": [["cloud"]],
                 "MOCK_UPDATE_PHONE_CALLED": [],
                 "MOCK_DELETE_PHONE_CALLED": [
                     {"phone_id": "cloud_phone_1"},
@@ -178,7 +245,8 @@ def mock_delete_phone(_, phone_id: str) -> Any:
                 "sephiroth",
             ],
             {
-                "MOCK_GET_USERS_CALLED_COUNT": 1,
+                "MOCK_GET_USERS_CALLED_COUNT": 0,
+                "MOCK_GET_USERS_BY_NAMES_CALLED": [["cloud", "sephiroth"]],
                 "MOCK_UPDATE_PHONE_CALLED": [],
                 "MOCK_DELETE_PHONE_CALLED": [
                     {"phone_id": "cloud_phone_1"},
@@ -208,27 +276,367 @@ def mock_delete_phone(_, phone_id: str) -> Any:
         ),
     ],
 )
+@pytest.mark.usefixtures("mock_duo")
 def test_end_to_end(monkeypatch, test_input, expected):
     """Test"""
-    global MOCK_GET_USERS_CALLED_COUNT
-    global MOCK_UPDATE_PHONE_CALLED
-    global MOCK_DELETE_PHONE_CALLED
-    MOCK_GET_USERS_CALLED_COUNT = 0
-    MOCK_UPDATE_PHONE_CALLED = []
-    MOCK_DELETE_PHONE_CALLED = []
-    monkeypatch.setattr(duo_client.Admin, "get_users", mock_get_users)
-    monkeypatch.setattr(duo_client.Admin, "update_phone", mock_update_phone)
-    monkeypatch.setattr(duo_client.Admin, "delete_phone", mock_delete_phone)
     monkeypatch.setattr("builtins.input", lambda: "y")  # Always input yes
 
     program.main(argv=test_input)
 
     assert (
         MOCK_GET_USERS_CALLED_COUNT == expected["MOCK_GET_USERS_CALLED_COUNT"]
-    ), "`get_users` was not called the expected number of times"
-    assert (
-        MOCK_UPDATE_PHONE_CALLED == expected["MOCK_UPDATE_PHONE_CALLED"]
+    ), "The whole directory was not fetched the expected number of times"
+    assert MOCK_GET_USERS_BY_NAMES_CALLED == (
+        expected["MOCK_GET_USERS_BY_NAMES_CALLED"]
+    ), "Users were not looked up by the expected usernames"
+    # Phones may be processed concurrently, so the order of calls is not fixed
+    assert sorted(MOCK_UPDATE_PHONE_CALLED, key=lambda x: x["phone_id"]) == (
+        expected["MOCK_UPDATE_PHONE_CALLED"]
     ), "`update_phone` was not called for the expected phones"
-    assert (
-        MOCK_DELETE_PHONE_CALLED == expected["MOCK_DELETE_PHONE_CALLED"]
+    assert sorted(MOCK_DELETE_PHONE_CALLED, key=lambda x: x["phone_id"]) == (
+        expected["MOCK_DELETE_PHONE_CALLED"]
     ), "`delete_phone` was not called for the expected phones"
+
+
+@pytest.mark.usefixtures("mock_duo")
+def test_usernames_batched(monkeypatch):
+    """Test that users are looked up by at most `USERNAME_LIST_LIMIT` names at once"""
+    monkeypatch.setattr("duo.USERNAME_LIST_LIMIT", 2)
+
+    program.main(
+        argv=[
+            "--skey",
+            "myskey",
+            "--ikey",
+            "myikey",
+            "--host",
+            "myhost.domain.tld",
+            "sephiroth",
+            "barret",
+            "cloud",
+        ]
+    )
+
+    assert MOCK_GET_USERS_CALLED_COUNT == 0, "The whole directory was fetched"
+    assert MOCK_GET_USERS_BY_NAMES_CALLED == [
+        ["barret", "cloud"],
+        ["sephiroth"],
+    ], "Users were not looked up in batches of the expected usernames"
+    assert sorted(MOCK_DELETE_PHONE_CALLED, key=lambda x: x["phone_id"]) == [
+        {"phone_id": "cloud_phone_1"},
+        {"phone_id": "sephiroth_phone_1"},
+    ], "`delete_phone` was not called for the expected phones"
+
+
+@pytest.mark.usefixtures("mock_duo")
+def test_user_cache_fallback(monkeypatch, tmp_path):
+    """
+    Test that the cached user list is used when users cannot be fetched from Duo
+    """
+    args = [
+        "--skey",
+        "myskey",
+        "--ikey",
+        "myikey",
+        "--host",
+        "myhost.domain.tld",
+        "--cache-ttl",
+        "10",
+        "--cache-dir",
+        str(tmp_path),
+        "-vvv",
+    ]
+
+    # Populate the cache
+    program.main(argv=args)
+    assert MOCK_GET_USERS_CALLED_COUNT == 1
+    cached = program.UserCache(
+        directory=tmp_path, ttl=600, host="myhost.domain.tld", ikey="myikey"
+    ).load()
+    assert cached is not None, "User cache was not written"
+    assert {key for user in cached["users"] for key in user} == {
+        "username",
+        "user_id",
+        "phones",
+    }, "User cache kept more of the users than needed"
+    assert {
+        key for user in cached["users"] for phone in user["phones"] for key in phone
+    } == {
+        "phone_id",
+        "platform",
+        "name",
+    }, "User cache kept more of the phones than needed"
+
+    def mock_get_users_failure(_) -> Iterator[dict]:
+        # Fail partway through paging through the users
+        yield from mock_get_users(_)[:2]
+        raise RuntimeError("Received 503 Service Unavailable")
+
+    monkeypatch.setattr(duo_client.Admin, "get_users_iterator", mock_get_users_failure)
+    MOCK_DELETE_PHONE_CALLED.clear()
+
+    program.main(argv=args)
+    assert sorted(MOCK_DELETE_PHONE_CALLED, key=lambda x: x["phone_id"]) == [
+        {"phone_id": "cloud_phone_1"},
+        {"phone_id": "sephiroth_phone_1"},
+    ], "Cached user list was not used when Duo was unavailable"
+
+    # Two days later, the cached user list is too old to fall back on
+    now = time.time() + 2 * 24 * 60 * 60
+    monkeypatch.setattr("time.time", lambda: now)
+    MOCK_DELETE_PHONE_CALLED.clear()
+
+    with pytest.raises(SystemExit, match="^1$"):
+        program.main(argv=args)
+    assert not MOCK_DELETE_PHONE_CALLED, "Too old a cached user list was used"
+
+
+@pytest.mark.usefixtures("mock_duo")
+def test_user_cache_reuse(monkeypatch, tmp_path):
+    """
+    Test that a fresh cached user list is used instead of fetching from Duo, up
+    until a run changes a phone
+    """
+    # Decline every action when prompted
+    monkeypatch.setattr("builtins.input", lambda: "n")
+    args = [
+        "--skey",
+        "myskey",
+        "--ikey",
+        "myikey",
+        "--host",
+        "myhost.domain.tld",
+        "--cache-ttl",
+        "10",
+        "--cache-dir",
+        str(tmp_path),
+        "-vvv",
+    ]
+
+    program.main(argv=args + ["--no-force"])
+    program.main(argv=args + ["--no-force"])
+    assert MOCK_GET_USERS_CALLED_COUNT == 1, "Fresh cached user list was not used"
+
+    program.main(argv=args + ["--no-force", "--ikey", "myotherikey"])
+    assert (
+        MOCK_GET_USERS_CALLED_COUNT == 2
+    ), "Cached user list was shared with another integration"
+
+    program.main(argv=args)
+    assert MOCK_GET_USERS_CALLED_COUNT == 2, "Fresh cached user list was not used"
+    assert MOCK_DELETE_PHONE_CALLED, "No phones were removed"
+
+    program.main(argv=args + ["--no-force"])
+    assert (
+        MOCK_GET_USERS_CALLED_COUNT == 3
+    ), "Cached user list was still used after phones were changed"
+
+
+@pytest.mark.usefixtures("mock_duo")
+def test_user_cache_recheck(monkeypatch, tmp_path, caplog):
+    """
+    Test that phones from a fresh cached user list are looked up in Duo again
+    before being removed, and left alone if they have changed since
+    """
+    program.UserCache(
+        directory=tmp_path, ttl=600, host="myhost.domain.tld", ikey="myikey"
+    ).store(USERS)
+
+    def mock_get_phone_by_id_changed(_, phone_id: str) -> dict:
+        if phone_id == "cloud_phone_1":
+            # The user has since finished registering their phone
+            return {"name": "1", "phone_id": phone_id, "platform": "Apple iOS"}
+        if phone_id == "sephiroth_phone_1":
+            # Someone else has since removed it
+            return mock_get_phone_by_id(_, "no_such_phone")
+        return mock_get_phone_by_id(_, phone_id)
+
+    monkeypatch.setattr(
+        duo_client.Admin, "get_phone_by_id", mock_get_phone_by_id_changed
+    )
+    caplog.set_level(logging.DEBUG, logger="duo")
+
+    program.main(
+        argv=[
+            "--skey",
+            "myskey",
+            "--ikey",
+            "myikey",
+            "--host",
+            "myhost.domain.tld",
+            "--cache-ttl",
+            "10",
+            "--cache-dir",
+            str(tmp_path),
+        ]
+    )
+
+    assert MOCK_GET_USERS_CALLED_COUNT == 0, "Fresh cached user list was not used"
+    assert not any(
+        "fetched from Duo" in message for message in caplog.messages
+    ), "Users from the cache were logged as fetched from Duo"
+    assert not MOCK_DELETE_PHONE_CALLED, "Phones changed in Duo were removed"
+
+
+@pytest.mark.parametrize(
+    "entry",
+    [
+        {"generated_at": 1700000000, "users": []},
+        {"generated_at": 1700000000, "stale_at": 4000000000},
+        {"generated_at": 1700000000, "stale_at": 4000000000, "users": {}},
+        {"generated_at": "yesterday", "stale_at": 4000000000, "users": []},
+        [],
+    ],
+    ids=["no stale_at", "no users", "users not a list", "bad generated_at", "list"],
+)
+@pytest.mark.usefixtures("mock_duo")
+def test_user_cache_unreadable(tmp_path, entry):
+    """Test that a malformed cache file is ignored rather than crashing the run"""
+    cache = program.UserCache(
+        directory=tmp_path, ttl=600, host="myhost.domain.tld", ikey="myikey"
+    )
+    cache.path.write_bytes(gzip.compress(json.dumps(entry).encode("utf-8")))
+
+    assert cache.load() is None, "Malformed user cache was loaded"
+    program.main(
+        argv=[
+            "--skey",
+            "myskey",
+            "--ikey",
+            "myikey",
+            "--host",
+            "myhost.domain.tld",
+            "--cache-ttl",
+            "10",
+            "--cache-dir",
+            str(tmp_path),
+        ]
+    )
+    assert MOCK_GET_USERS_CALLED_COUNT == 1, "Users were not fetched from Duo"
+
+
+@pytest.mark.usefixtures("mock_duo")
+def test_approve_all(monkeypatch):
+    """
+    Test that answering "all" to a confirmation prompt approves every remaining
+    action without prompting again
+    """
+    answers = iter(["all"])
+    monkeypatch.setattr("builtins.input", lambda: next(answers))
+
+    program.main(
+        argv=[
+            "--skey",
+            "myskey",
+            "--ikey",
+            "myikey",
+            "--host",
+            "myhost.domain.tld",
+            "--no-force",
+            "-vvv",
+        ]
+    )
+
+    assert sorted(MOCK_UPDATE_PHONE_CALLED, key=lambda x: x["phone_id"]) == [
+        {"phone_id": "aerith_phone_1"},
+        {"phone_id": "barret_phone_1"},
+        {"phone_id": "yuffie_phone_1"},
+    ], "`update_phone` was not called for the expected phones"
+    assert sorted(MOCK_DELETE_PHONE_CALLED, key=lambda x: x["phone_id"]) == [
+        {"phone_id": "cloud_phone_1"},
+        {"phone_id": "sephiroth_phone_1"},
+    ], "`delete_phone` was not called for the expected phones"
+
+
+def test_empty_argv(monkeypatch):
+    """An empty argument list must not fall back to parsing `sys.argv`"""
+    monkeypatch.setattr("sys.argv", ["duo_phone_cleanup", "--not-an-option"])
+    monkeypatch.setenv("DUO_HOST", "myhost.domain.tld")
+
+    args = program.parse_args([])
+
+    assert args.host == "myhost.domain.tld"
+    assert not args.users
+
+
+@pytest.mark.parametrize(
+    "test_input,environ",
+    [
+        (["--workers", "0"], {}),
+        (["--workers", "-1"], {}),
+        ([], {"DUO_WORKERS": "0"}),
+        (["--rate-limit", "-1"], {}),
+        (["--rate-limit", "nan"], {}),
+        (["--cache-ttl", "-5"], {}),
+        ([], {"DUO_CACHE_TTL": "-5"}),
+    ],
+)
+def test_invalid_args(monkeypatch, test_input, environ):
+    """Test that unusable numbers are rejected when parsing the arguments"""
+    for key, value in environ.items():
+        monkeypatch.setenv(key, value)
+
+    with pytest.raises(SystemExit, match="^2$"):
+        program.parse_args(test_input)
+
+
+@pytest.mark.usefixtures("mock_duo")
+def test_timestamp_per_run(monkeypatch):
+    """Test that every phone stamped in a run gets the same Unix time"""
+    names: List[str] = []
+    monkeypatch.setattr(
+        duo_client.Admin,
+        "update_phone",
+        lambda _, *, phone_id, name: names.append(name),
+    )
+    monkeypatch.setattr("time.time", lambda: 1700000000.5)
+
+    program.main(
+        argv=["--skey", "myskey", "--ikey", "myikey", "--host", "myhost.domain.tld"]
+    )
+
+    assert names == ["1700000000"] * 3, "Phones were not stamped as expected"
+
+
+def test_user_verify_answers(monkeypatch):
+    """Test that unrecognised answers are asked again rather than guessed at"""
+    answers = iter(["abort", " No ", "maybe", "YES"])
+    monkeypatch.setattr("builtins.input", lambda: next(answers))
+    user_verify = program.UserVerify()
+
+    assert not user_verify("First?"), "`No` was not taken as a rejection"
+    assert user_verify("Second?"), "`YES` was not taken as an approval"
+    assert not user_verify.approve_all, "Actions were approved all at once"
+
+
+@pytest.mark.usefixtures("mock_duo")
+def test_failed_phone(monkeypatch):
+    """Test that failing to act on one phone does not stop the others"""
+
+    def mock_delete_phone_failing(_, phone_id: str) -> Any:
+        if phone_id == "cloud_phone_1":
+            raise RuntimeError("Received 429 Too Many Requests")
+        return mock_delete_phone(_, phone_id)
+
+    def mock_update_phone_failing(_, *, phone_id: str, name: str) -> Any:
+        if phone_id == "yuffie_phone_1":
+            # Not an `OSError`, unlike most connection problems
+            raise http.client.IncompleteRead(b"")
+        return mock_update_phone(_, phone_id=phone_id, name=name)
+
+    monkeypatch.setattr(duo_client.Admin, "delete_phone", mock_delete_phone_failing)
+    monkeypatch.setattr(duo_client.Admin, "update_phone", mock_update_phone_failing)
+
+    # Exits with status 1 to report the failure
+    with pytest.raises(SystemExit, match="^1$"):
+        program.main(
+            argv=["--skey", "myskey", "--ikey", "myikey", "--host", "myhost.domain.tld"]
+        )
+
+    assert sorted(MOCK_UPDATE_PHONE_CALLED, key=lambda x: x["phone_id"]) == [
+        {"phone_id": "aerith_phone_1"},
+        {"phone_id": "barret_phone_1"},
+    ], "`update_phone` was not called for the expected phones"
+    assert MOCK_DELETE_PHONE_CALLED == [
+        {"phone_id": "sephiroth_phone_1"},
+    ], "`delete_phone` was not called for the expected phones"